@@ -1,27 +1,152 @@
 import asyncio
 import json
+import re
+import traceback
 from pathlib import Path
 
 
+# kanata sends one compact JSON object per line; anything larger than this is
+# not a message we know about and is dropped instead of growing the buffer.
+MAX_LINE_SIZE = 64 * 1024
+READ_SIZE = 4096
+
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+# kanata answers the resync request right away, so only a connection that
+# stayed up this long (in seconds) resets the reconnect delay.
+STABLE_CONNECTION = 5.0
+
+REQUEST_CURRENT_LAYER = b'{"RequestCurrentLayerName":{}}\n'
+
+# Fast path for the messages kanata sends all the time; the layer name is
+# captured only when it needs no JSON unescaping, anything else goes through
+# json.loads.
+FAST_MESSAGES = {
+    b'{"LayerChange":': (
+        "LayerChange",
+        "new",
+        re.compile(rb'\{"new":"([^"\\\x00-\x1f]*)"\}\}'),
+    ),
+    b'{"CurrentLayerName":': (
+        "CurrentLayerName",
+        "name",
+        re.compile(rb'\{"name":"([^"\\\x00-\x1f]*)"\}\}'),
+    ),
+}
+
+
+def decode_message(line):
+    for prefix, (kind, key, pattern) in FAST_MESSAGES.items():
+        if line.startswith(prefix):
+            m = pattern.fullmatch(line, len(prefix))
+            if m:
+                return {kind: {key: m.group(1).decode()}}
+            break
+    return json.loads(line)
+
+
 class KanataClient:
     def __init__(self, renderer, viewer, params):
         self.renderer = renderer
         self.viewer = viewer
         self.params = params
         self.hidden_layer = ["base"]
+        self.layer = None
 
     async def run(self):
-        reader, writer = await asyncio.open_connection(**self.params)
+        delay = RECONNECT_DELAY
         while True:
-            line = await reader.readline()
-            data = json.loads(line)
-            match data:
-                case {"LayerChange": {"new": name}}:
+            if await self.handle_connection():
+                delay = RECONNECT_DELAY
+            print(f"Reconnecting to kanata in {delay:g}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def handle_connection(self):
+        """Run one session with kanata, return whether it stayed up long enough."""
+        try:
+            reader, writer = await asyncio.open_connection(**self.params)
+        except OSError as e:
+            print("Cannot connect to kanata:", e)
+            return False
+        print("Connected to kanata")
+        loop = asyncio.get_running_loop()
+        connected_at = loop.time()
+        try:
+            # the layer may have changed while we were disconnected
+            writer.write(REQUEST_CURRENT_LAYER)
+            await writer.drain()
+        except OSError as e:
+            print("Connection to kanata lost:", e)
+        else:
+            async for line in self.read_lines(reader):
+                try:
+                    self.handle_line(line)
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            # do not leave a stale layer on screen, resync will show it again
+            self.layer = None
+            self.viewer.hide()
+        return loop.time() - connected_at >= STABLE_CONNECTION
+
+    async def read_lines(self, reader):
+        buffer = bytearray()
+        discarding = False
+        while True:
+            try:
+                chunk = await reader.read(READ_SIZE)
+            except OSError as e:
+                print("Connection to kanata lost:", e)
+                break
+            if not chunk:
+                print("Connection to kanata closed")
+                break
+            buffer += chunk
+            start = 0
+            while (end := buffer.find(b"\n", start)) != -1:
+                if discarding:
+                    discarding = False
+                elif end - start > MAX_LINE_SIZE:
+                    print("Dropping oversized message from kanata")
+                else:
+                    yield bytes(buffer[start:end])
+                start = end + 1
+            del buffer[:start]
+            if len(buffer) > MAX_LINE_SIZE:
+                if not discarding:
+                    print("Dropping oversized message from kanata")
+                discarding = True
+                buffer.clear()
+        # a partial line left at EOF is an incomplete message, drop it
+
+    def handle_line(self, line):
+        if not line.strip():
+            return
+        try:
+            data = decode_message(line)
+        except ValueError:
+            print("invalid message!", line)
+            return
+        match data:
+            case {"LayerChange": {"new": name}}:
+                print("Active layer:", name)
+                self.layer = name
+                self.viewer.focus(name)
+            case {"CurrentLayerName": {"name": name}}:
+                if name != self.layer:
                     print("Active layer:", name)
+                    self.layer = name
                     self.viewer.focus(name)
-                case {"ConfigFileReload": {"new": path}}:
-                    print("Reload config")
-                    self.viewer.hide()
-                    self.renderer.load_config(Path(path))
-                case _:
-                    print("unknown message!", data)
+            case {"ConfigFileReload": {"new": path}}:
+                print("Reload config")
+                self.layer = None
+                self.viewer.hide()
+                self.renderer.load_config(Path(path))
+            case _:
+                print("unknown message!", data)
@@ -0,0 +1,231 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from kanata_layer_viewer import client as client_module
+from kanata_layer_viewer.client import (
+    MAX_LINE_SIZE,
+    RECONNECT_DELAY,
+    RECONNECT_MAX_DELAY,
+    REQUEST_CURRENT_LAYER,
+    KanataClient,
+    decode_message,
+)
+
+
+class ChunkReader:
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    async def read(self, n):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+def read_lines(*chunks):
+    async def collect():
+        client = KanataClient(None, None, {})
+        return [line async for line in client.read_lines(ChunkReader(*chunks))]
+
+    return asyncio.run(collect())
+
+
+def test_line_split_across_chunks():
+    assert read_lines(b'{"LayerCh', b'ange":{"new"', b':"nav"}}\n') == [
+        b'{"LayerChange":{"new":"nav"}}'
+    ]
+
+
+def test_oversized_line_over_several_reads():
+    chunks = [b"x" * (MAX_LINE_SIZE // 2)] * 4
+    assert read_lines(*chunks, b"x\nvalid\n") == [b"valid"]
+
+
+def test_line_of_max_size():
+    line = b"x" * MAX_LINE_SIZE
+    assert read_lines(line + b"\n", b"x" * (MAX_LINE_SIZE + 1) + b"\nok\n") == [
+        line,
+        b"ok",
+    ]
+
+
+def test_partial_line_at_eof():
+    assert read_lines(b"first\nsecond\npart") == [b"first", b"second"]
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        b'{"LayerChange":{"new":"nav"}}',
+        b'{"LayerChange":{"new":"num\\u00e9"}}',
+        b'{"LayerChange":{"new":"a\\"b"}}',
+        b'{"LayerChange":{"new":"\xc3\xa9mojis"}}',
+        b'{"LayerChange":{"name":"nav"}}',
+        b'{"CurrentLayerName":{"name":"base"}}',
+        b'{"CurrentLayerName":{"name":"a\\\\b"}}',
+        b'{"CurrentLayerName":{"new":"base"}}',
+        b'{"ConfigFileReload":{"new":"/etc/kanata/kanata.kbd"}}',
+    ],
+)
+def test_decode_message_matches_json(line):
+    assert decode_message(line) == json.loads(line)
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        b'{"LayerChange":{"new":"nav"}}',
+        b'{"LayerChange":{"new":"\xc3\xa9mojis"}}',
+        b'{"CurrentLayerName":{"name":"base"}}',
+    ],
+)
+def test_decode_message_fast_path(line, monkeypatch):
+    expected = json.loads(line)
+
+    def loads(line):
+        raise AssertionError("fast path not taken")
+
+    monkeypatch.setattr(client_module, "json", SimpleNamespace(loads=loads))
+    assert decode_message(line) == expected
+
+
+class Viewer:
+    def __init__(self):
+        self.calls = []
+
+    def focus(self, name):
+        self.calls.append(("focus", name))
+
+    def hide(self):
+        self.calls.append(("hide",))
+
+
+class Renderer:
+    def load_config(self, path):
+        raise Exception("Unexpected action")
+
+
+class Kanata:
+    """Fake kanata server sending the same messages on each connection."""
+
+    def __init__(self, *messages):
+        self.messages = messages
+        self.requests = []
+
+    async def handle(self, reader, writer):
+        self.requests.append(await reader.readline())
+        for message in self.messages:
+            writer.write(message + b"\n")
+        await writer.drain()
+        writer.close()
+
+    async def client(self, renderer=None):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        host, port = server.sockets[0].getsockname()
+        self.server = server
+        return KanataClient(renderer, Viewer(), {"host": host, "port": port})
+
+
+def test_handle_connection_resync_and_teardown():
+    kanata = Kanata(b'{"CurrentLayerName":{"name":"nav"}}')
+
+    async def session():
+        client = await kanata.client()
+        stable = await client.handle_connection()
+        kanata.server.close()
+        return client, stable
+
+    client, stable = asyncio.run(session())
+    assert kanata.requests == [REQUEST_CURRENT_LAYER]
+    assert client.viewer.calls == [("focus", "nav"), ("hide",)]
+    assert client.layer is None
+    # kanata answering the resync request is not enough to reset the backoff
+    assert not stable
+
+
+def test_handle_connection_stable(monkeypatch):
+    monkeypatch.setattr(client_module, "STABLE_CONNECTION", 0)
+    kanata = Kanata()
+
+    async def session():
+        client = await kanata.client()
+        stable = await client.handle_connection()
+        kanata.server.close()
+        return stable
+
+    assert asyncio.run(session())
+
+
+def test_handler_error_keeps_connection():
+    kanata = Kanata(
+        b'{"ConfigFileReload":{"new":"/etc/kanata/kanata.kbd"}}',
+        b'{"LayerChange":{"new":"num"}}',
+    )
+
+    async def session():
+        client = await kanata.client(Renderer())
+        await client.handle_connection()
+        kanata.server.close()
+        return client
+
+    client = asyncio.run(session())
+    assert len(kanata.requests) == 1
+    assert ("focus", "num") in client.viewer.calls
+
+
+def test_run_reconnects(monkeypatch):
+    monkeypatch.setattr(client_module, "RECONNECT_DELAY", 0)
+    kanata = Kanata(b'{"CurrentLayerName":{"name":"nav"}}')
+
+    async def session():
+        client = await kanata.client()
+        task = asyncio.create_task(client.run())
+        while len(kanata.requests) < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        kanata.server.close()
+        return client
+
+    client = asyncio.run(session())
+    assert kanata.requests[:3] == [REQUEST_CURRENT_LAYER] * 3
+    assert client.viewer.calls[:4] == [("focus", "nav"), ("hide",)] * 2
+
+
+class Stop(Exception):
+    pass
+
+
+def run_backoff(monkeypatch, sessions):
+    delays = []
+    sessions = list(sessions)
+
+    async def handle_connection():
+        if not sessions:
+            raise Stop
+        return sessions.pop(0)
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    client = KanataClient(None, Viewer(), {})
+    monkeypatch.setattr(client, "handle_connection", handle_connection)
+    monkeypatch.setattr(client_module, "asyncio", SimpleNamespace(sleep=sleep))
+    with pytest.raises(Stop):
+        asyncio.run(client.run())
+    return delays
+
+
+def test_run_backoff(monkeypatch):
+    delays = run_backoff(monkeypatch, [False] * 9)
+    assert delays[0] == RECONNECT_DELAY
+    assert delays == [
+        min(RECONNECT_DELAY * 2**i, RECONNECT_MAX_DELAY) for i in range(9)
+    ]
+    assert delays[-1] == RECONNECT_MAX_DELAY
+
+
+def test_run_backoff_reset(monkeypatch):
+    delays = run_backoff(monkeypatch, [False, False, True, False])
+    d = RECONNECT_DELAY
+    assert delays == [d, d * 2, d, d * 2]